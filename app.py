@@ -1,12 +1,58 @@
 import os
+
+# จำกัด intra-op thread ไว้ 1 ต่อ worker (ต้องตั้งก่อน import torch)
+# บน vCPU ที่แชร์กันของ Render การ spawn หลาย thread มีแต่แย่ง cache กันเอง
+# ไปสเกลด้วยจำนวน process ของ uvicorn (--workers) แทน
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+# ห้าม OpenMP spin รอ (busy-wait) หลังจบงาน — บนโควตา ~0.1 CPU ของ Render
+# การ spin คือการเผา quota ทิ้งเฉย ๆ
+os.environ.setdefault("KMP_BLOCKTIME", "0")
+
+import hashlib
+import io
+import logging
+import logging.handlers
+import queue
 import cv2
 import numpy as np
+import asyncio
 import gc
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 import torch
-import sys
+
+cv2.setNumThreads(1)
+torch.set_num_threads(1)
+torch.set_num_interop_threads(1)
+# เซิร์ฟเวอร์นี้ inference อย่างเดียว — ปิด autograd ทั้ง process เลย
+# จะได้ไม่ต้องครอบ no_grad ทุกจุด และไม่เผลอสร้าง graph ให้เปลือง RAM
+torch.set_grad_enabled(False)
 from fastapi import FastAPI, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from ultralytics import YOLO
+from PIL import Image
+
+# libjpeg-turbo decode ตรงจาก DCT domain (เร็วกว่า imdecode+resize มากสำหรับรูปมือถือ)
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    _TURBO = TurboJPEG()
+except Exception:
+    _TURBO = None
+
+# Log บน request path ผ่านคิว — I/O ลง stdout ไปทำใน thread ของ listener
+# (print ล็อก stdout ทุกครั้ง ทำให้ thread แย่งกันตอนโหลดหนัก)
+_LOG_QUEUE: queue.SimpleQueue = queue.SimpleQueue()
+log = logging.getLogger("banana")
+log.setLevel(logging.WARNING)
+log.addHandler(logging.handlers.QueueHandler(_LOG_QUEUE))
+log.propagate = False
+_LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, logging.StreamHandler())
+_LOG_LISTENER.start()
 
 app = FastAPI(title="Banana Expert AI Server (3-Model Edition)")
 
@@ -20,103 +66,691 @@ app.add_middleware(
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# ไฟล์ calibration สำหรับ INT8 (ภาพกล้วยตัวแทน ~200 ภาพจาก validation set)
+CALIB_YAML = os.path.join(BASE_DIR, "model/calib.yaml")
+
+# ถ้ามี GPU ให้รันบน CUDA ไม่งั้นใช้ CPU (Render Free Tier)
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+# คอนฟิกผ่าน env — deploy ทุกที่ใช้ไฟล์นี้ไฟล์เดียว ไม่ต้อง fork app.py หลายชุด
+MODEL_MAIN_PATH   = os.environ.get("YOLO_MODEL_PATH", "model/best_modelv8sbg.pt")
+MODEL_BACKUP_PATH = os.environ.get("YOLO_BACKUP_PATH", "model/best_modelv8nbg.pt")
+IMGSZ       = int(os.environ.get("YOLO_IMGSZ", "512"))
+CONF_MAIN   = float(os.environ.get("YOLO_CONF_THRESHOLD", "0.25"))
+CONF_BACKUP = float(os.environ.get("YOLO_BACKUP_CONF", "0.20"))
+
+# เปิด TF32 tensor core บน Ampere+ (mAP แทบไม่ต่าง) และให้ cuDNN autotune
+# เลือก conv algorithm ที่เร็วสุด — ปลอดภัยเพราะ input shape ของเราคงที่
+torch.set_float32_matmul_precision("high")
+torch.backends.cudnn.benchmark = True
+
+
+def _cpu_bf16_ok() -> bool:
+    # bf16 คุ้มเฉพาะ CPU ที่มี AVX-512 BF16 จริง — ไม่งั้น oneDNN emulate แล้วช้ากว่า FP32
+    # torch 2.2 ไม่มี API ถามตรง ๆ จึงเช็ค ISA หยาบ ๆ แล้วลองคูณ matrix จิ๋ว
+    # ใต้ autocast จริง ๆ เลย: รันผ่านและได้ bf16 ออกมาค่อยเปิดใช้
+    try:
+        if not torch.backends.mkldnn.is_available():
+            return False
+        if str(torch.backends.cpu.get_cpu_capability()) != "AVX512":
+            return False
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            out = torch.mm(torch.ones(2, 2), torch.ones(2, 2))
+        return out.dtype == torch.bfloat16
+    except Exception:
+        return False
+
+
+# ถ้ารองรับ ให้แคสต์น้ำหนักโมเดล torch เป็น bfloat16 — ขนย้ายจาก DRAM ครึ่งเดียว
+USE_BF16 = DEVICE == "cpu" and _cpu_bf16_ok()
+
+
+def _amp_ctx():
+    """Context สำหรับครอบ predict — autocast bf16 เมื่อเปิดใช้ ไม่งั้น no-op"""
+    if USE_BF16:
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return nullcontext()
+
+
+def _best_from_raw(out: np.ndarray, conf: float):
+    """Postprocess output ดิบ (B, 4+nc, N) ของ YOLOv8 คืน (conf, cls) หรือ None ต่อภาพ"""
+    bests = []
+    for pred in out:
+        scores = pred[4:]  # คะแนนต่อคลาส ต่อกล่อง (sigmoid แล้ว)
+        flat = int(scores.argmax())
+        cls_id, box_i = divmod(flat, scores.shape[1])
+        c = float(scores[cls_id, box_i])
+        bests.append((c, cls_id) if c >= conf else None)
+    return bests
+
+
+class ORTDetector:
+    """Session onnxruntime ตรง ๆ + postprocess เองด้วย numpy
+
+    ตัด overhead ฝั่ง Python ของ Ultralytics (สร้าง Results object + NMS loop)
+    ออกทั้งก้อน — endpoint เราใช้แค่กล่องที่มั่นใจสุด เลยไม่ต้อง NMS เต็มรูปแบบ
+    """
+
+    _fp16 = False  # ให้ interface เดียวกับ YOLO ที่แปะ flag นี้
+
+    def __init__(self, onnx_path: str):
+        import onnxruntime as ort
+        # ถ้ามีกราฟ INT8 ที่ quantize ไว้ล่วงหน้า (optimum-cli onnxruntime quantize
+        # --avx512_vnni) ให้ใช้ก่อน — VNNI ยิง int8 dot-product 4 ตัวต่อ lane
+        int8_path = os.path.splitext(onnx_path)[0] + "_int8.onnx"
+        if os.path.exists(int8_path):
+            onnx_path = int8_path
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = int(os.environ.get("OMP_NUM_THREADS", "1"))
+        self.sess = ort.InferenceSession(onnx_path, opts,
+                                         providers=["CPUExecutionProvider"])
+        self.input_name = self.sess.get_inputs()[0].name
+        self.output_name = self.sess.get_outputs()[0].name
+
+    def best_boxes(self, batch: np.ndarray, conf: float):
+        """รับ batch (B,3,H,W) fp32 คืน list ของ (conf, cls) หรือ None ต่อภาพ"""
+        io_binding = self.sess.io_binding()
+        io_binding.bind_cpu_input(self.input_name, np.ascontiguousarray(batch))
+        io_binding.bind_output(self.output_name, "cpu")
+        self.sess.run_with_iobinding(io_binding)
+        return _best_from_raw(io_binding.get_outputs()[0].numpy(), conf)
+
+
+class OVDetector:
+    """OpenVINO Runtime ตรง ๆ (compile_model) — postprocess ร่วมกับ ORTDetector
+
+    PERFORMANCE_HINT=LATENCY ให้ runtime จัด thread/stream เพื่อ latency ต่อ request
+    ไม่ใช่ throughput รวม ซึ่งตรงกับงาน API ของเรา
+    """
+
+    _fp16 = False
+
+    def __init__(self, xml_path: str):
+        import openvino as ov
+        self.compiled = ov.Core().compile_model(
+            xml_path, "CPU", {"PERFORMANCE_HINT": "LATENCY"}
+        )
+
+    def best_boxes(self, batch: np.ndarray, conf: float):
+        """รับ batch (B,3,H,W) fp32 คืน list ของ (conf, cls) หรือ None ต่อภาพ"""
+        out = self.compiled([np.ascontiguousarray(batch)])[0]
+        return _best_from_raw(out, conf)
+
+
+@contextmanager
+def _mmap_torch_load():
+    """บังคับ torch.load ใน block นี้ให้ mmap ไฟล์ checkpoint แทนอ่านเข้า RAM ทั้งก้อน
+
+    Kernel จะ page น้ำหนักเข้ามาเฉพาะหน้า (page) ที่ถูกแตะจริง และไล่คืนได้
+    ตอน RAM ตึง — ช่วย cold-start RSS บนเพดาน 512 MB ของ Render Free
+    ต้อง patch แบบนี้เพราะ ultralytics เรียก torch.load เองข้างใน YOLO()
+    """
+    orig = torch.load
+
+    def _load(*args, **kwargs):
+        kwargs.setdefault("mmap", True)
+        try:
+            return orig(*args, **kwargs)
+        except TypeError:
+            # torch เก่าไม่รู้จัก mmap= -> โหลดแบบปกติ
+            kwargs.pop("mmap", None)
+            return orig(*args, **kwargs)
+
+    torch.load = _load
+    try:
+        yield
+    finally:
+        torch.load = orig
+
+
+def load_detector(pt_path: str, imgsz: int):
+    """โหลดโมเดล detect ตามลำดับ INT8 -> FP16 -> FP32 (.pt) แล้วแต่ว่าเครื่องรองรับอะไร"""
+    if torch.cuda.is_available():
+        engine_path = os.path.splitext(pt_path)[0] + ".engine"
+        try:
+            if not os.path.exists(engine_path):
+                # Export ล่วงหน้าครั้งเดียว: INT8 ลด bandwidth ของ weight ~4 เท่า
+                YOLO(pt_path).export(
+                    format="engine", int8=True, imgsz=imgsz,
+                    data=CALIB_YAML, workspace=4, dynamic=True, batch=8,
+                )
+            return YOLO(engine_path, task="detect")
+        except Exception as e:
+            # ไม่มีชุด calibration -> ถอยไป FP16 ซึ่งไม่ต้อง calibrate และ mAP แทบไม่ตก
+            print(f"⚠️ TensorRT INT8 export failed ({os.path.basename(pt_path)}): {e}")
+
+        half_path = os.path.splitext(pt_path)[0] + "_fp16.engine"
+        try:
+            if not os.path.exists(half_path):
+                YOLO(pt_path).export(format="engine", half=True, imgsz=imgsz,
+                                     dynamic=True, batch=8)
+                os.rename(os.path.splitext(pt_path)[0] + ".engine", half_path)
+            detector = YOLO(half_path, task="detect")
+            detector._fp16 = True  # ให้ predict() ส่ง activation เป็น fp16 ด้วย
+            return detector
+        except Exception as e:
+            print(f"⚠️ TensorRT FP16 export failed ({os.path.basename(pt_path)}): {e}")
+        with _mmap_torch_load():
+            return YOLO(pt_path)
+
+    # ไม่มี GPU (เช่นบน Render) -> ลอง OpenVINO INT8 ซึ่งใช้ AVX-512 VNNI บน x86
+    ov_dir = os.path.splitext(pt_path)[0] + "_int8_openvino_model"
+    try:
+        if not os.path.isdir(ov_dir):
+            YOLO(pt_path).export(format="openvino", int8=True, imgsz=imgsz, data=CALIB_YAML)
+        xml = next(f for f in os.listdir(ov_dir) if f.endswith(".xml"))
+        return OVDetector(os.path.join(ov_dir, xml))
+    except Exception as e:
+        # ไม่มี openvino/nncf หรือชุด calibration -> ลอง ONNXRuntime ก่อนถอยไป .pt
+        print(f"⚠️ OpenVINO INT8 export failed ({os.path.basename(pt_path)}): {e}")
+
+    onnx_path = os.path.splitext(pt_path)[0] + ".onnx"
+    try:
+        if not os.path.exists(onnx_path):
+            # dynamic=True ให้แกน batch ยืดได้ — micro-batcher ยิง B รูปใน run เดียว
+            YOLO(pt_path).export(format="onnx", imgsz=imgsz, opset=17,
+                                 simplify=True, dynamic=True)
+        return ORTDetector(onnx_path)
+    except Exception as e:
+        print(f"⚠️ ONNXRuntime path unavailable ({os.path.basename(pt_path)}): {e}")
+    with _mmap_torch_load():
+        return YOLO(pt_path).to("cpu")
+
+
 # 2. โหลดโมเดล (เน้นใช้ CPU สำหรับ Render Free Tier)
-print("🚀 Loading 3 Models...")
+# หมายเหตุ: ตัดโมเดลกรอง Stage 1 ออกแล้ว ใช้ confidence ของโมเดลหลักเป็นตัวกรองแทน
+# ประหยัด forward pass เต็ม ๆ หนึ่งรอบ + RAM ของ yolov8s อีกชุดต่อ request
+# โหลดใน background ตอน startup (ดู _boot ข้างล่าง) ให้ uvicorn bind port ได้ทันที
+MODEL_MAIN = None
+MODEL_BACKUP = None
+
+
+def _prep_torch_model(m):
+    """แต่ง module ฝั่ง torch (.pt) ให้พร้อมเสิร์ฟ — ต้องทำ "หลัง" predict รอบแรก
+
+    AutoBackend ของ ultralytics สร้าง predictor ตอน predict ครั้งแรก และระหว่าง
+    นั้นมัน fuse โมเดล + แคสต์กลับ fp32 — ถ้าไปแต่ง m.model ก่อนหน้า ทั้ง
+    torch.compile และ bf16 จะโดนล้างทิ้งเงียบ ๆ จึงยิง dummy หนึ่งรอบให้
+    predictor เกิดก่อน แล้วค่อยแต่ง module ตัวที่ predictor ถืออยู่จริง
+    """
+    if not isinstance(getattr(m, "model", None), torch.nn.Module):
+        return m  # engine/openvino/onnx ถูกคอมไพล์มาแล้ว ไม่ต้องแตะ
+    try:
+        m.predict(source=np.zeros((IMGSZ, IMGSZ, 3), np.uint8), imgsz=IMGSZ,
+                  device=DEVICE, verbose=False)
+        backend = m.predictor.model  # AutoBackend ที่ถูกใช้เสิร์ฟจริง
+        # NHWC (channels_last) ทำให้ conv ของ cuDNN/oneDNN ใช้ vectorized load ที่เร็วกว่า
+        net = backend.model.eval().to(memory_format=torch.channels_last)
+        if USE_BF16:
+            # น้ำหนัก bf16 + autocast ตอน predict — input fp32 ถูกแคสต์ให้เอง
+            net = net.to(torch.bfloat16)
+        # Fuse elementwise op ใน forward ด้วย Inductor ลดจำนวน kernel launch ~10 เท่า
+        net = torch.compile(net, mode="reduce-overhead", fullgraph=False, dynamic=False)
+        backend.model = net
+        # ยืนยันว่าของที่แต่งไม่โดนสลับออก — เคยพลาดแบบเงียบ ๆ มาแล้วรอบหนึ่ง
+        assert m.predictor.model.model is net, "prepped module was swapped out"
+        if USE_BF16:
+            assert next(net.parameters()).dtype == torch.bfloat16, "bf16 cast reverted"
+    except Exception as e:
+        print(f"⚠️ model prep skipped (serving unoptimized fp32): {e}")
+    return m
+
+
+def load_models():
+    global MODEL_MAIN
+    print("🚀 Loading Models...")
+    try:
+        # โหลดเฉพาะโมเดลหลัก (Stage 2) — ตัวสำรองโหลดแบบ lazy ใน get_backup()
+        main = load_detector(os.path.join(BASE_DIR, MODEL_MAIN_PATH), imgsz=IMGSZ)
+        _prep_torch_model(main)
+
+        # อุ่นเครื่อง 3 รอบ ให้ torch.compile / cudnn autotune จ่ายค่า compile
+        # จนหมดก่อนเปิดรับ request จริง (รอบแรกคือ compile รอบถัดไปคือ autotune)
+        # อุ่นไม่ผ่าน = โมเดลรัน forward ไม่ได้เลย — ห้ามเอาขึ้นเสิร์ฟ
+        dummy = preprocess(np.zeros((IMGSZ, IMGSZ, 3), np.uint8))
+        for _ in range(3):
+            infer_single(main, dummy, conf=CONF_MAIN)
+
+        # compile แบบ dynamic=False จะ specialize ต่อ shape — ต้องอุ่นทุกขนาด batch
+        # ที่ batcher ยิงจริง (1..MAX_BATCH) ไม่งั้น request แรกของแต่ละขนาดโดน
+        # recompile หลายวินาทีคา request path (_BUF ปลอดภัย: คิวยังว่างก่อน publish)
+        for i in range(MAX_BATCH):
+            _BUF[i] = dummy
+        for n in range(1, MAX_BATCH + 1):
+            _run_batch(n, main)
+    except Exception as e:
+        # รันใน thread แยก จึง exit ไม่ได้ — ปล่อยให้ /detect ตอบ 503 ต่อไป
+        print(f"❌ CRITICAL ERROR: Could not load models: {e}")
+        raise
+
+    MODEL_MAIN = main  # ตั้งเป็นตัวสุดท้าย — /detect เปิดรับงานเมื่อทุกอย่างพร้อม
+    print("✅ Models Loaded: Main ready (Backup deferred)")
+
+
+_BACKUP_LOCK = threading.Lock()
+
+
+def get_backup():
+    """โหลดโมเดลสำรอง (Stage 3) ครั้งแรกที่ตัวหลักพลาดจริง ๆ เท่านั้น
+
+    Request ปกติไม่เคยแตะตัวสำรอง — โหลดค้างไว้ตั้งแต่บูตมีแต่กิน RAM ~30-40 MB
+    ของ v8n ไปเปล่า ๆ ซึ่งสำคัญมากบนเพดาน 512 MB ของ Render Free
+    """
+    global MODEL_BACKUP
+    if MODEL_BACKUP is None:
+        with _BACKUP_LOCK:
+            if MODEL_BACKUP is None:
+                log.warning("🚀 Loading Backup Model (first miss)...")
+                m = load_detector(os.path.join(BASE_DIR, MODEL_BACKUP_PATH), imgsz=IMGSZ)
+                MODEL_BACKUP = _prep_torch_model(m)
+    return MODEL_BACKUP
+
+# ต่ำกว่านี้ถือว่าไม่ใช่กล้วย — ต้องต่ำกว่า CONF_MAIN/CONF_BACKUP เพราะเกตนี้
+# วัด conf ของโมเดลหลัก/สำรอง ไม่ใช่ของโมเดลกรองเดิม (0.35 ของตัวกรองจะไป
+# ปัดผลที่เคยผ่านเกณฑ์ 0.20-0.25 ทิ้งหมด)
+NO_BANANA_THRESHOLD = float(os.environ.get("NO_BANANA_THRESHOLD", "0.15"))
+
+# แผนผังสายพันธุ์กล้วย — ใช้ numpy array แทน dict: index ตรง ๆ ไม่ต้อง hash
+CLASS_KEYS = np.array([
+    "Candyapple", "Namwa", "Namwadam", "Homthong", "Nak",
+    "Thepphanom", "Kai", "Lepchanggud", "Ngachang", "Huamao",
+], dtype=object)
+
+# Kernel เดียวจัดการ BGR->RGB + HWC->CHW + หาร 255 (ปกติ Ultralytics ทำแยก 4-5 รอบ)
 try:
-    # โมเดลกรองภาพ (Stage 1)
-    MODEL_FILTER = YOLO(os.path.join(BASE_DIR, "model/best_m1_bgv8s.pt")).to("cpu")
-    # โมเดลหลัก (Stage 2)
-    MODEL_MAIN   = YOLO(os.path.join(BASE_DIR, "model/best_modelv8sbg.pt")).to("cpu")
-    # โมเดลสำรอง (Stage 3)
-    MODEL_BACKUP = YOLO(os.path.join(BASE_DIR, "model/best_modelv8nbg.pt")).to("cpu")
-    print("✅ All 3 Models Loaded: Filter, Main, and Backup")
-except Exception as e:
-    print(f"❌ CRITICAL ERROR: Could not load models: {e}")
-    sys.exit(1)
-
-# แผนผังสายพันธุ์กล้วย
-CLASS_KEYS = {
-    0: "Candyapple", 1: "Namwa", 2: "Namwadam", 3: "Homthong",
-    4: "Nak", 5: "Thepphanom", 6: "Kai", 7: "Lepchanggud",
-    8: "Ngachang", 9: "Huamao",
-}
-
-# ฟังก์ชันอ่านรูปภาพแบบ Async (แก้ Error 422)
-async def read_image(file: UploadFile):
-    # ต้องใช้ await เพราะ FastAPI อ่านไฟล์เป็น Stream
-    contents = await file.read() 
+    import numba
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _bgr_to_chw_norm(src, dst):
+        for y in numba.prange(src.shape[0]):
+            for x in range(src.shape[1]):
+                dst[0, y, x] = src[y, x, 2] / 255.0
+                dst[1, y, x] = src[y, x, 1] / 255.0
+                dst[2, y, x] = src[y, x, 0] / 255.0
+except Exception:
+    def _bgr_to_chw_norm(src, dst):
+        np.divide(src[..., ::-1].transpose(2, 0, 1), 255.0, out=dst)
+
+# จองบัฟเฟอร์ fp32 ไว้ล่วงหน้าครั้งเดียว ไม่ต้อง alloc ใหม่ทุก request
+_BUF = np.empty((8, 3, IMGSZ, IMGSZ), np.float32)
+
+# Scratch uint8 สำหรับผล resize — แยกต่อ thread เผื่อไปรันใน threadpool ของ FastAPI
+_TLS = threading.local()
+
+
+def _resize_scratch(size: int) -> np.ndarray:
+    buf = getattr(_TLS, "resized_%d" % size, None)
+    if buf is None:
+        buf = np.empty((size, size, 3), np.uint8)
+        setattr(_TLS, "resized_%d" % size, buf)
+    return buf
+
+
+def _resize_into(img: np.ndarray, size: int, dst: np.ndarray):
+    # ย่อรูปใหญ่ใช้ INTER_AREA (เร็วกว่าและไม่เกิด aliasing) ขยายรูปเล็กใช้ INTER_LINEAR
+    interp = cv2.INTER_AREA if max(img.shape[0], img.shape[1]) > size else cv2.INTER_LINEAR
+    cv2.resize(img, (size, size), dst=dst, interpolation=interp)
+
+# บน GPU: จอง pinned host buffer + stream แยก เพื่อให้ H2D copy เป็น async
+# และทับซ้อนกับ compute ของ request ก่อนหน้า (pageable copy จะ block stream)
+# ชุดนี้เป็นของ batcher ผู้เดียว — batcher ประมวลทีละ batch จึงไม่ชนกันเอง
+if DEVICE == "cuda":
+    _PIN = torch.empty((8, 3, IMGSZ, IMGSZ), dtype=torch.float32, pin_memory=True)
+    _DEV = torch.empty_like(_PIN, device="cuda")
+    _COPY_STREAM = torch.cuda.Stream()
+
+
+def _stage_to_gpu(t, pin, dev, stream):
+    n = t.shape[0]
+    with torch.cuda.stream(stream):
+        pin[:n].copy_(t)
+        dev[:n].copy_(pin[:n], non_blocking=True)
+    torch.cuda.current_stream().wait_stream(stream)
+    return dev[:n]
+
+
+def _tls_staging():
+    # ชุด staging (pinned/device/stream) แยกต่อ thread สำหรับ infer_single
+    # ใช้ชุดของ batcher ร่วมไม่ได้ — ตัวสำรองที่รันคู่ขนานจะเขียนทับ buffer
+    # ระหว่างที่ batch หลักกำลังถูก copy/อ่านอยู่
+    st = getattr(_TLS, "staging", None)
+    if st is None:
+        pin = torch.empty((1, 3, IMGSZ, IMGSZ), dtype=torch.float32, pin_memory=True)
+        st = (pin, torch.empty_like(pin, device="cuda"), torch.cuda.Stream())
+        _TLS.staging = st
+    return st
+
+
+def _best_box(result):
+    """คืน (conf, cls) ของกล่องที่มั่นใจสุดจาก Results หรือ None ถ้าไม่เจออะไร"""
+    if result is None or result.boxes is None or len(result.boxes) == 0:
+        return None
+    boxes = result.boxes
+    best = torch.argmax(boxes.conf)
+    # stack แล้ว tolist ทีเดียว → sync ข้าม device ครั้งเดียว แทนที่จะ .item() สองรอบ
+    conf, cls_id = torch.stack((boxes.conf[best], boxes.cls[best])).tolist()
+    return float(conf), int(cls_id)
+
+
+def preprocess(img: np.ndarray) -> np.ndarray:
+    """แปลงภาพ BGR เป็น CHW fp32 ครั้งเดียว — stage หลักและสำรองใช้ array เดียวกัน
+    ไม่ต้อง resize + normalize ซ้ำตอน fallback"""
+    resized = _resize_scratch(IMGSZ)
+    _resize_into(img, IMGSZ, resized)
+    # array นี้ถูกอ้างค้างไว้ทั้งในคิวของ batcher (ไม่มีเพดาน) และ thread ของ
+    # ตัวสำรอง — ต้องจองใหม่ต่อ request เวียนใช้ pool ไม่ได้ เดี๋ยวภาพโดนทับ
+    # ระหว่างรอคิวแล้วไปตอบผลของรูปคนอื่น (scratch ด้านบนปลอดภัยเพราะใช้จบในนี้)
+    chw = np.empty((3, IMGSZ, IMGSZ), np.float32)
+    _bgr_to_chw_norm(resized, chw)
+    return chw
+
+
+def infer_single(model, chw: np.ndarray, conf: float):
+    """ยิงโมเดลด้วย tensor ภาพเดียว คืน (conf, cls) หรือ None — ใช้ได้ทุก backend
+
+    ใช้ buffer แยกต่อ thread ไม่แตะ _BUF ของ batcher จึงรันคู่ขนานกันได้"""
+    buf = getattr(_TLS, "single_buf", None)
+    if buf is None:
+        buf = np.empty((1, 3, IMGSZ, IMGSZ), np.float32)
+        _TLS.single_buf = buf
+    buf[0] = chw
+    if isinstance(model, (ORTDetector, OVDetector)):
+        return model.best_boxes(buf, conf)[0]
+    t = torch.from_numpy(buf)
+    if DEVICE == "cuda":
+        pin, dev, stream = _tls_staging()
+        t = _stage_to_gpu(t, pin, dev, stream)
+    with _amp_ctx():
+        r = model.predict(
+            source=t.contiguous(memory_format=torch.channels_last), conf=conf,
+            iou=0.7, max_det=1, device=DEVICE,
+            half=getattr(model, "_fp16", False), verbose=False
+        )[0]
+    return _best_box(r)
+
+
+# Thread เดียวสำหรับงานตัวสำรองทั้งหมด — YOLO object ของ ultralytics เก็บ state
+# (predictor/batch) ไว้ในตัว ไม่ thread-safe ถ้า predict ซ้อนกันจาก 2 thread
+_SPEC_EXEC = ThreadPoolExecutor(max_workers=1)
+
+# ยิงตัวสำรองคู่ขนาน (speculative) เฉพาะตอนเปิด env นี้ — future ที่รันแล้ว
+# cancel ไม่ได้ แปลว่า request ปกติต้องจ่ายค่า forward ของตัวสำรองทิ้งทุกครั้ง
+# ซึ่งบนโควตา ~0.1 CPU ของ Render มักทำให้ช้าลงมากกว่าเร็วขึ้น
+SPECULATE_BACKUP = os.environ.get("SPECULATE_BACKUP", "0") == "1"
+
+# Micro-batching: รวมภาพจากหลาย request ที่มาไล่เลี่ยกันยิงโมเดลหลักครั้งเดียว
+MAX_BATCH = 8
+MAX_WAIT_MS = 20
+_BATCH_QUEUE: asyncio.Queue = asyncio.Queue()
+
+
+def _run_batch(n: int, model=None):
+    # งาน sync ของ batcher: ยิงโมเดลหลักกับ _BUF[:n] — เรียกผ่าน executor เท่านั้น
+    # (ยกเว้น warmup ตอนโหลด ซึ่งส่ง model มาเองก่อน MODEL_MAIN จะถูกตั้ง)
+    model = MODEL_MAIN if model is None else model
+    if isinstance(model, (ORTDetector, OVDetector)):
+        return model.best_boxes(_BUF[:n], conf=CONF_MAIN)
+    batch = torch.from_numpy(_BUF[:n])
+    if DEVICE == "cuda":
+        batch = _stage_to_gpu(batch, _PIN, _DEV, _COPY_STREAM)
+    batch = batch.contiguous(memory_format=torch.channels_last)
+    with _amp_ctx():
+        results = model.predict(
+            source=batch, conf=CONF_MAIN, iou=0.7, max_det=1,
+            device=DEVICE, half=getattr(model, "_fp16", False),
+            verbose=False
+        )
+    return [_best_box(r) for r in results]
+
+
+async def _batcher():
+    # Background task: เก็บภาพจากคิวให้ได้มากสุด MAX_BATCH (รอเพื่อนไม่เกิน MAX_WAIT_MS)
+    # แล้ว predict ทีเดียว เพื่อเฉลี่ย overhead ต่อ call ไปหลาย ๆ request
+    loop = asyncio.get_running_loop()
+    while True:
+        chw, fut = await _BATCH_QUEUE.get()
+        chws, futs = [chw], [fut]
+        deadline = loop.time() + MAX_WAIT_MS / 1000
+        while len(chws) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                chw, fut = await asyncio.wait_for(_BATCH_QUEUE.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            chws.append(chw)
+            futs.append(fut)
+        try:
+            # ภาพถูก preprocess มาแล้วจาก detect() — แค่วางเรียงลง batch buffer
+            n = len(chws)
+            for i, c in enumerate(chws):
+                _BUF[i] = c
+            # forward pass กินเป็นสิบ-ร้อย ms — ห้ามรันคา event loop ไม่งั้น
+            # ทั้ง server ค้าง (เหตุผลเดียวกับที่ decode ไปอยู่ใน threadpool)
+            # batcher await ทีละ batch จึงไม่มีใครแตะ _BUF ซ้อนกัน
+            bests = await loop.run_in_executor(None, _run_batch, n)
+            for f, b in zip(futs, bests):
+                if not f.done():
+                    f.set_result(b)
+        except Exception as e:
+            for f in futs:
+                if not f.done():
+                    f.set_exception(e)
+
+
+async def infer_main(chw: np.ndarray):
+    # ส่ง tensor ที่ preprocess แล้วเข้าคิว รอผลจาก batcher
+    fut = asyncio.get_running_loop().create_future()
+    await _BATCH_QUEUE.put((chw, fut))
+    return await fut
+
+
+@app.on_event("startup")
+async def _boot():
+    asyncio.create_task(_batcher())
+    # โหลดโมเดลใน thread แยก — uvicorn bind port ได้เลย healthcheck ของ Render ไม่ timeout
+    fut = asyncio.get_running_loop().run_in_executor(None, load_models)
+    # อย่าทิ้ง future — ถ้าโหลด/อุ่นเครื่องพัง ต้องเห็นใน log ไม่ใช่ 503 เงียบตลอดกาล
+    fut.add_done_callback(
+        lambda f: f.exception() and log.error("❌ Model load failed: %s", f.exception())
+    )
+
+
+# เกิน ~8000x8000 ถือว่าเป็น JPEG bomb — decode อาจกินเป็นวินาทีและ RAM หลักร้อย MB
+MAX_PIXELS = 64_000_000
+
+# เพดานขนาดไฟล์อัปโหลด — กัน client แปลก ๆ ยัด body ยักษ์จน RAM บาน
+MAX_UPLOAD_BYTES = 8 * 1024 * 1024
+
+
+# Cache คำตอบตาม SHA-256 ของไฟล์ — มือถือ retry / หน้าเทสยิงรูปเดิมซ้ำบ่อยมาก
+# (hash 500 KB ไม่ถึง ms เทียบกับ inference หลักสิบ ms)
+_CACHE: OrderedDict = OrderedDict()
+_CACHE_MAX = 1024
+
+
+def _cache_put(key: bytes, resp: dict) -> dict:
+    _CACHE[key] = resp
+    _CACHE.move_to_end(key)
+    if len(_CACHE) > _CACHE_MAX:
+        _CACHE.popitem(last=False)
+    return resp
+
+
+# ฟังก์ชันอ่านไฟล์อัปโหลดแบบ Async (แก้ Error 422)
+async def read_upload(file: UploadFile):
+    """อ่าน body เป็น chunk คืน (contents, reason) โดย contents เป็น None ถ้าไฟล์ใหญ่เกิน"""
+    buf = bytearray()
+    while chunk := await file.read(64 * 1024):
+        buf.extend(chunk)
+        if len(buf) > MAX_UPLOAD_BYTES:
+            return None, "file_too_large"
+    return bytes(buf), None
+
+
+# Fast-reject จากสีก่อนเข้าโมเดล — ปิดเป็นค่าเริ่มต้น เพราะ heuristic สี
+# มีโอกาสปัดรูปกล้วยแสงแปลก ๆ ทิ้ง เปิดเฉพาะตอนโดนถล่มด้วยรูปขยะเยอะ ๆ
+FAST_REJECT = os.environ.get("FAST_REJECT", "0") == "1"
+FAST_REJECT_MIN_SAT = float(os.environ.get("FAST_REJECT_MIN_SAT", "0.08"))
+
+
+def _fast_reject(contents: bytes) -> bool:
+    """เดาเร็ว ๆ ว่าภาพแทบไร้สี (สแกนเอกสาร/ภาพขาวดำ) → ไม่ใช่กล้วยแน่
+
+    ต้องส่ง bytes เต็มไฟล์ — ส่งแค่หัวไฟล์ convert() จะเจอ stream ขาดแล้ว
+    โยน OSError ทุกครั้ง กลายเป็นไม่เคย reject อะไรเลย ความถูกของทางนี้
+    มาจาก draft() ที่ให้ libjpeg ย่อส่วนตั้งแต่ DCT domain ไม่ใช่จากอ่านน้อย
+    อ่านไม่ได้เมื่อไรให้คืน False — ปล่อยผ่านให้โมเดลตัดสินเสมอ
+    """
+    try:
+        im = Image.open(io.BytesIO(contents))
+        im.draft("RGB", (128, 128))
+        sat = np.asarray(im.convert("HSV").resize((32, 32)))[..., 1]
+        return float(sat.mean()) / 255.0 < FAST_REJECT_MIN_SAT
+    except Exception:
+        return False
+
+
+def decode_image(contents: bytes):
+    """Decode ภาพจาก bytes คืน (img, reason) โดย img เป็น None ถ้าใช้ไม่ได้"""
+    # PIL อ่านขนาดจาก header โดยไม่ decode พิกเซล — กันภาพยักษ์ก่อนเสียแรง
+    try:
+        w0, h0 = Image.open(io.BytesIO(contents)).size
+        if w0 * h0 > MAX_PIXELS:
+            return None, "image_too_large"
+    except Exception:
+        pass  # format ที่ PIL ไม่รู้จัก ปล่อยให้ decoder ข้างล่างตัดสิน
+    # ดูจาก magic bytes ก่อนเลยว่าเป็น JPEG ไหม (\xff\xd8) — PNG/WEBP จะได้
+    # วิ่งเข้า OpenCV ตรง ๆ ไม่ต้องเสียรอบให้ TurboJPEG โยน exception ก่อน
+    if _TURBO is not None and contents[:2] == b"\xff\xd8":
+        try:
+            w, h, _, _ = _TURBO.decode_header(contents)
+            # เลือกสเกล IDCT 1/2, 1/4, 1/8 ให้ด้านสั้นยังไม่ต่ำกว่าขนาด input ของโมเดล
+            # จะได้ไม่ต้อง decode รูปมือถือ 4032x3024 เต็ม ๆ แล้วค่อยย่อทีหลัง
+            den = 1
+            while den < 8 and min(w, h) // (den * 2) >= IMGSZ:
+                den *= 2
+            return _TURBO.decode(contents, scaling_factor=(1, den), pixel_format=TJPF_BGR), None
+        except Exception:
+            pass  # ไม่ใช่ไฟล์ JPEG -> ถอยไปใช้ OpenCV ตามเดิม
     data = np.frombuffer(contents, np.uint8)
-    return cv2.imdecode(data, cv2.IMREAD_COLOR)
+    # ไฟล์ใหญ่ (น่าจะเป็นรูปมือถือ): ให้ libjpeg ถอดแบบย่อ 1/4 หรือ 1/2 ในตัว
+    # ได้ผลคล้ายเส้นทาง TurboJPEG ข้างบน — งาน IDCT เหลือ 1/16-1/4
+    if len(contents) > 500_000:
+        img = cv2.imdecode(data, cv2.IMREAD_REDUCED_COLOR_4)
+        if img is not None and min(img.shape[:2]) < IMGSZ:
+            # ย่อ 1/4 แล้วเล็กเกิน input ของโมเดล -> ถอยมาที่ 1/2
+            img = cv2.imdecode(data, cv2.IMREAD_REDUCED_COLOR_2)
+        if img is not None and min(img.shape[:2]) >= IMGSZ:
+            return img, None
+    return cv2.imdecode(data, cv2.IMREAD_COLOR), None
+
+# นับ request เพื่อเก็บกวาด cycle แบบนาน ๆ ครั้ง (การ walk heap ทุก request แพงเปล่า ๆ)
+_REQUEST_COUNT = 0
+
 
 @app.post("/detect")
 async def detect(image: UploadFile = File(...)):
-    img = None
+    global _REQUEST_COUNT
+    # โมเดลยังโหลดไม่เสร็จ -> บอก client ให้ลองใหม่ (อย่าคิวงานค้างไว้)
+    if MODEL_MAIN is None:
+        return JSONResponse({"success": False, "reason": "warming_up"}, status_code=503)
+    _REQUEST_COUNT += 1
+    if _REQUEST_COUNT % 500 == 0:
+        gc.collect()
     try:
         # อ่านไฟล์ที่ส่งมา
-        img = await read_image(image)
-        if img is None: 
-            return {"success": False, "reason": "invalid_image"}
-
-        # --- STAGE 1 : FILTER (กรองว่าใช่กล้วยไหม) ---
-        with torch.no_grad():
-            r1 = MODEL_FILTER.predict(
-                source=img, conf=0.35, imgsz=416, device="cpu", verbose=False
-            )[0]
-        
-        if r1.boxes is None or len(r1.boxes) == 0:
-            return {"success": False, "reason": "no_banana_detected"}
+        contents, reject = await read_upload(image)
+        if contents is None:
+            return {"success": False, "reason": reject}
+
+        # เคยเห็นไฟล์นี้แล้ว -> ตอบจาก cache ไม่ต้อง decode/inference ซ้ำ
+        cache_key = hashlib.sha256(contents).digest()
+        cached = _CACHE.get(cache_key)
+        if cached is not None:
+            _CACHE.move_to_end(cache_key)
+            return cached
+
+        # (opt-in) ปัดภาพไร้สีทิ้งด้วย decode ย่อส่วนราคาถูก ก่อนจ่ายค่า decode เต็ม
+        if FAST_REJECT and _fast_reject(contents):
+            return _cache_put(cache_key, {"success": False, "reason": "no_banana_detected"})
+
+        # Decode เป็นงาน C หนัก ๆ 5-20 ms — โยนเข้า threadpool ให้ event loop
+        # ว่างไปรับ connection อื่นระหว่างนั้น (libjpeg ปล่อย GIL)
+        img, reject = await asyncio.get_running_loop().run_in_executor(
+            None, decode_image, contents
+        )
+        if img is None:
+            return {"success": False, "reason": reject or "invalid_image"}
+
+        # เตรียม tensor ครั้งเดียว — โมเดลหลักและตัวสำรองใช้ร่วมกัน
+        chw = preprocess(img)
 
         # --- STAGE 2 : MAIN DETECTION ---
-        final_result = None
+        # โหมด speculative (opt-in): ถ้าตัวสำรองโหลดแล้ว ยิงคู่ขนานไปเลย
+        # ตอนยังไม่โหลด/ไม่เปิด ไม่ยิง — ตัวสำรองจะถูกเรียกเฉพาะตอนพลาดจริง
+        final_best = None
         is_backup_used = False
+        backup_fut = None
+        if SPECULATE_BACKUP and MODEL_BACKUP is not None:
+            backup_fut = asyncio.get_running_loop().run_in_executor(
+                _SPEC_EXEC, infer_single, MODEL_BACKUP, chw, CONF_BACKUP
+            )
+            backup_fut.add_done_callback(lambda f: f.cancelled() or f.exception())
 
+        # แยกให้ออกระหว่าง "โมเดลรันจบแต่ไม่เจอกล่อง" (= ไม่ใช่กล้วย) กับ
+        # "โมเดลพัง" (= all_models_failed) — สองอย่างนี้ตอบ client คนละแบบ
+        model_ran = False
         try:
-            with torch.no_grad():
-                r_main = MODEL_MAIN.predict(
-                    source=img, conf=0.25, imgsz=512, device="cpu", verbose=False
-                )[0]
-            
-            if r_main.boxes is not None and len(r_main.boxes) > 0:
-                final_result = r_main
-            else:
-                raise ValueError("Main model found nothing")
-
+            final_best = await infer_main(chw)
+            model_ran = True
         except Exception as e:
-            # --- STAGE 3 : BACKUP (ใช้ตัวสำรองถ้าตัวหลักพลาด) ---
-            print(f"🔄 Switching to Backup Model: {e}")
+            log.warning("🔄 Switching to Backup Model: %s", e)
+
+        if final_best is None:
+            # --- STAGE 3 : BACKUP (ตัวหลักพังหรือไม่เจออะไรเลย) ---
             is_backup_used = True
-            with torch.no_grad():
-                final_result = MODEL_BACKUP.predict(
-                    source=img, conf=0.20, imgsz=512, device="cpu", verbose=False
-                )[0]
+            try:
+                if backup_fut is None:
+                    # ครั้งแรกที่พลาด: โหลด+ยิงตัวสำรองใน executor เดิม
+                    backup_fut = asyncio.get_running_loop().run_in_executor(
+                        _SPEC_EXEC, lambda: infer_single(get_backup(), chw, CONF_BACKUP)
+                    )
+                final_best = await backup_fut
+                model_ran = True
+            except Exception as e:
+                log.warning("⚠️ Backup model failed: %s", e)
 
         # ตรวจสอบผลลัพธ์สุดท้ายก่อนส่งคืน
-        if final_result is None or final_result.boxes is None or len(final_result.boxes) == 0:
+        if final_best is None:
+            if model_ran:
+                # ทั้งคู่รันปกติแต่ไม่มีกล่องผ่านเกณฑ์ conf เลย = ภาพนี้ไม่ใช่กล้วย
+                # (หน้าที่เดิมของโมเดลกรอง Stage 1) — ผล deterministic จึง cache ได้
+                return _cache_put(cache_key, {"success": False, "reason": "no_banana_detected"})
             return {"success": False, "reason": "all_models_failed"}
 
-        # ดึงค่าที่แม่นยำที่สุดออกไป
-        confs = final_result.boxes.conf.cpu().numpy()
-        clses = final_result.boxes.cls.cpu().numpy().astype(int)
-        best_idx = int(confs.argmax())
-        
-        return {
+        best_conf, best_cls = final_best
+
+        # เกตเสริมแบบปรับได้: ค่า default ต่ำกว่า CONF_MAIN/CONF_BACKUP จึงไม่ตัดอะไร
+        # เพิ่มจากเกณฑ์ของโมเดล — มีผลเฉพาะตอนตั้ง env NO_BANANA_THRESHOLD สูงขึ้นเอง
+        if best_conf < NO_BANANA_THRESHOLD:
+            return _cache_put(cache_key, {"success": False, "reason": "no_banana_detected"})
+
+        return _cache_put(cache_key, {
             "success": True,
-            "banana_key": CLASS_KEYS.get(int(clses[best_idx]), "unknown"),
-            "confidence": round(float(confs[best_idx]), 4),
+            "banana_key": CLASS_KEYS[best_cls] if 0 <= best_cls < len(CLASS_KEYS) else "unknown",
+            "confidence": round(best_conf, 4),
             "used_backup": is_backup_used
-        }
+        })
 
     except Exception as e:
-        print(f"❌ Server Error: {e}")
+        log.error("❌ Server Error: %s", e, exc_info=e)
         return {"success": False, "reason": "server_error"}
-    finally:
-        # เคลียร์ Memory เพื่อไม่ให้ Server ล่ม (สำคัญมากสำหรับ Render)
-        if img is not None: 
-            del img
-        gc.collect()
 
 if __name__ == "__main__":
     import uvicorn
     # ปรับให้ใช้ Port จาก Render อัตโนมัติ
     port = int(os.environ.get("PORT", 10000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+    uvicorn.run("app:app", host="0.0.0.0", port=port, workers=workers)